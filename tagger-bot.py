@@ -1,91 +1,246 @@
+import atexit
 import collections
-import contextlib
-import dataclasses
 import difflib
 import gettext
 import json
-import locale
 import logging
+import os
 import pathlib
-import textwrap
+import stat
+import sys
+import tempfile
+import threading
 
 gettext.bindtextdomain("taggerbot", "locale")
 gettext.textdomain("taggerbot")
 
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # pragma: no cover - fall back to the stdlib matcher
+    process = None  # type: ignore[assignment]
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - fall back to the stdlib json module
+    orjson = None  # type: ignore[assignment]
 
 _ = gettext.gettext
 
 logger = logging.getLogger(__name__)
 
 
+# Minimum similarity (see TagMapping.nearest) for a tag to be suggested
+SUGGESTION_THRESHOLD = 0.75
+
+
 class MissingParameterError(Exception):
     pass
 
 
 class TagMapping:
-    def __init__(self, key="mapping"):
-        self.tags = collections.defaultdict(set)
-        self.users = collections.defaultdict(set)
-        self.dirty = False
+    __slots__ = (
+        "tags",
+        "users",
+        "limit",
+        "limit_version",
+        "version",
+        "_stored_version",
+        "_stored_limit_version",
+        "key",
+        "limit_key",
+        "_dumped",
+        "_dirty_tags",
+        "_sorted",
+        "_searches",
+    )
+
+    # Number of search results kept, see search()
+    SEARCH_CACHE_SIZE = 128
+
+    def __init__(self, key="mapping", limit_key="limit"):
+        self.tags: Dict[str, Set[str]] = {}
+        # Built on the first lookup by user, see find()
+        self.users: Optional[Dict[str, Set[str]]] = None
+        self.limit: FrozenSet[str] = frozenset()
+        self.limit_version = 0  # Increased whenever the limit changes
+        self.version = 0  # Increased whenever a tag changes
+        # Versions last written by store(), anything newer is unsaved
+        self._stored_version = self.version
+        self._stored_limit_version = self.limit_version
         self.key = key
+        self.limit_key = limit_key
+        self._dumped: Dict[str, List[str]] = {}
+        self._dirty_tags: Set[str] = set()
+        self._sorted: Dict[str, List[str]] = {}  # Sorted tags per user
+        self._searches: Dict[Tuple[FrozenSet[str], int, int], Tuple[str, ...]] = {}
 
     def dump(self):
-        return {t: list(us) for t, us in self.tags.items() if len(us) > 0}
+        # Only tags changed since the last dump are converted again. A copy
+        # is returned since storages may hold on to the value.
+        for t in self._dirty_tags:
+            if len(self.tags.get(t, ())) > 0:
+                self._dumped[t] = list(self.tags[t])
+            else:
+                self._dumped.pop(t, None)
+        self._dirty_tags.clear()
+        return dict(self._dumped)
 
     def load(self, storage):
         d = storage.get(self.key, {})
         self.tags.clear()
-        self.users.clear()
-        self.dirty = False
+        # Only built once it is needed, see find()
+        self.users = None
+        self.limit = frozenset(storage.get(self.limit_key, []))
+        self.limit_version += 1
+        self.version += 1
+        self._stored_version = self.version
+        self._stored_limit_version = self.limit_version
+        # Interning lets both indices share one object per tag and user name
+        intern, tag_index = sys.intern, self.tags
+        # The lists read here double as the cached dump of each tag
+        self._dumped.clear()
+        self._dirty_tags.clear()
         for tag, users in d.items():
-            self.tags[tag.lower()].update(users)
-            for user in users:
-                self.users[user].add(tag.lower())
+            if len(users) == 0:
+                continue
+            tag = intern(tag.lower())
+            users = [intern(user) for user in users]
+            if tag in tag_index:
+                # Merged with a differently cased tag, dump it again
+                tag_index[tag].update(users)
+                self._dirty_tags.add(tag)
+            else:
+                tag_index[tag] = set(users)
+                self._dumped[tag] = users
+        self._sorted.clear()
         return self
 
     def store(self, storage):
-        if self.dirty:
+        if self.version != self._stored_version:
             storage.put(self.key, self.dump())
-            self.dirty = False
+            self._stored_version = self.version
+        if self.limit_version != self._stored_limit_version:
+            storage.put(self.limit_key, list(self.limit))
+            self._stored_limit_version = self.limit_version
         return self
 
-    @contextlib.contextmanager
-    def use(self, storage):
-        self.load(storage)
-        yield self
-        self.store(storage)
-
     def add(self, user, *tags):
-        self.dirty = True
-        for tag in tags:
-            self.tags[tag.lower()].add(user)
-            self.users[user].add(tag.lower())
+        user = sys.intern(user)
+        for tag in map(sys.intern, tags):
+            users = self.tags.get(tag)
+            if users is None:
+                users = self.tags[tag] = set()
+            elif user in users:
+                continue
+            users.add(user)
+            if self.users is not None:
+                self.users.setdefault(user, set()).add(tag)
+            self._dirty_tags.add(tag)
+            self._sorted.pop(user, None)
+            self.version += 1
 
     def remove(self, user, *tags):
-        self.dirty = True
         for tag in tags:
-            self.tags[tag.lower()].discard(user)
-            self.users[user].discard(tag.lower())
+            if user not in self.tags.get(tag, ()):
+                continue
+            self.tags[tag].discard(user)
+            if self.users is not None:
+                self.users[user].discard(tag)
+            self._dirty_tags.add(tag)
+            self._sorted.pop(user, None)
+            self.version += 1
+            if len(self.tags[tag]) == 0:
+                # Unused tags are neither stored nor suggested
+                del self.tags[tag]
+
+    def set_limit(self, users):
+        users = frozenset(users)
+        if users != self.limit:
+            self.limit = users
+            self.limit_version += 1
 
     def find(self, tag=None, user=None):
         # assert tag is None ^ user is None
         if tag is not None:
-            return sorted(self.tags[tag.lower()])
+            return self.tags.get(tag, frozenset())
         if user is not None:
-            return sorted(self.users[user])
+            if self.users is None:
+                self.users = {}
+                for t, us in self.tags.items():
+                    for u in us:
+                        self.users.setdefault(u, set()).add(t)
+            if user not in self._sorted:
+                self._sorted[user] = sorted(self.users.get(user, ()))
+            return self._sorted[user]
         raise KeyError()
 
+    def search(self, tags) -> Tuple[str, ...]:
+        """
+        Find all users that have all of the lowercase `tags` and are
+        within the limit, if one is set. Results are sorted.
+        """
+        key = (frozenset(tags), self.version, self.limit_version)
+        result = self._searches.pop(key, None)
+        if result is None:
+            if self._searches and next(iter(self._searches))[1:] != key[1:]:
+                # All cached results belong to an older version, drop them
+                self._searches.clear()
+            elif len(self._searches) >= self.SEARCH_CACHE_SIZE:
+                # Hits move to the end, so the first one is least recently used
+                del self._searches[next(iter(self._searches))]
+            result = self._search(key[0])
+        self._searches[key] = result
+        return result
+
+    def _search(self, tags):
+        results = [self.find(tag=tag) for tag in tags]
+        if len(self.limit) > 0:
+            results.append(self.limit)
+        # Probe the other sets with the members of the smallest one
+        results.sort(key=len)
+        if len(results[0]) <= 1:
+            # Checking a single candidate directly is cheaper than intersecting
+            intersection = [u for u in results[0] if all(u in r for r in results[1:])]
+        else:
+            intersection = results[0].intersection(*results[1:])
+        return tuple(sorted(intersection))
+
     def __contains__(self, tag):
         return tag in self.tags
 
-    def nearest(self, tag) -> Tuple[str, float]:
+    def nearest(self, tag, cutoff=SUGGESTION_THRESHOLD) -> Tuple[str, float]:
+        """
+        Find the known tag closest to the lowercase `tag`.
+
+        Returns the tag and its similarity in the range [0, 1], or
+        `("", 0.0)` if no tag reaches `cutoff`. With rapidfuzz installed
+        this is the normalized Indel similarity, otherwise difflib's
+        Ratcliff-Obershelp ratio. Both agree closely on short strings like
+        tags, so the same suggestion threshold is used for either.
+        """
+        if tag in self.tags:
+            return tag, 1.0
+        # Both ratios are bounded by 2 * min(a, b) / (a + b), so candidates
+        # whose length is too far off can never reach the cutoff.
+        # The small slack keeps rounding from excluding exact boundary hits.
+        n = len(tag)
+        lower = cutoff * n / (2 - cutoff) - 1e-9
+        upper = n * (2 - cutoff) / cutoff + 1e-9 if cutoff > 0 else float("inf")
+        candidates = [t for t in self.tags if lower <= len(t) <= upper]
+        if process is not None:
+            match = process.extractOne(
+                tag, candidates, scorer=fuzz.ratio, score_cutoff=cutoff * 100
+            )
+            if match is None:
+                return "", 0.0
+            return match[0], match[1] / 100.0
+        scored = ((t, difflib.SequenceMatcher(a=t, b=tag).ratio()) for t in candidates)
         return max(
-            (
-                (t, difflib.SequenceMatcher(a=t.lower(), b=tag.lower()).ratio())
-                for t in self.tags.keys()
-            ),
+            (e for e in scored if e[1] >= cutoff),
             key=lambda e: e[1],
+            default=("", 0.0),
         )
 
 
@@ -99,15 +254,20 @@ class StorageContainer:
     def contains(self, key):
         raise NotImplementedError()
 
+    def refresh(self):
+        # True if the data was changed outside of this storage and reloaded.
+        # A change is reported once, so every handler opens its own storage.
+        return False
+
 
 class ZulipStorage(StorageContainer):
     def __init__(self, handler):
         self.handler = handler
 
     def get(self, key, default=None):
-        if self.contains(key):
+        try:
             return self.handler.storage.get(key)
-        else:
+        except KeyError:
             return default
 
     def put(self, key, val):
@@ -118,37 +278,110 @@ class ZulipStorage(StorageContainer):
 
 
 class JsonFileStorage(StorageContainer):
+    # Seconds to wait for further writes before the file is rewritten
+    FLUSH_DELAY = 0.5
+
     def __init__(self, fname):
         self.path = pathlib.Path(fname)
-        if self.path.exists():
-            self.data = json.load(self.path.open("r"))
-        else:
-            self.data = {}
+        self.data = {}
+        self._mtime = None
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()
+        self.refresh()
+        atexit.register(self._flush)
+
+    def refresh(self):
+        """
+        Reload the file if it was changed on disk. While a write of our own
+        is pending the in-memory data wins and is flushed over the file.
+        Each reload is reported only once, to the handler owning the storage.
+        """
+        with self._lock:
+            if self._dirty or not self.path.exists():
+                return False
+            mtime = self.path.stat().st_mtime_ns
+            if mtime == self._mtime:
+                return False
+            raw = self.path.read_bytes()
+            self.data = orjson.loads(raw) if orjson else json.loads(raw)
+            self._mtime = mtime
+            return True
 
     def get(self, key, default=None):
         return self.data.get(key, default)
 
     def put(self, key, val):
-        self.data[key] = val
-        json.dump(self.data, self.path.open("w"))
+        with self._lock:
+            self.data[key] = val
+            self._dirty = True
+            if self._timer is None:
+                self._schedule()
 
     def contains(self, key):
         return key in self.data
 
+    def _schedule(self):
+        # Called with the lock held
+        self._timer = threading.Timer(self.FLUSH_DELAY, self._flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            if orjson:
+                raw = orjson.dumps(self.data)
+            else:
+                raw = json.dumps(self.data).encode("utf-8")
+            try:
+                self._write(raw)
+            except Exception:
+                # The data stays dirty, so refresh() does not reload the file
+                # yet and the write is retried until it succeeds
+                logger.exception("Writing %s failed, retrying", self.path)
+                self._schedule()
+                return
+            self._mtime = self.path.stat().st_mtime_ns
+            self._dirty = False
+
+    def _write(self, raw):
+        f = tempfile.NamedTemporaryFile(
+            "wb", dir=self.path.parent, prefix=self.path.name, delete=False
+        )
+        try:
+            with f:
+                f.write(raw)
+            if self.path.exists():
+                # Temporary files are private, keep the store's own mode
+                os.chmod(f.name, stat.S_IMODE(self.path.stat().st_mode))
+            os.replace(f.name, self.path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+
 
 def read_parameters(params):
     if len(params) != 1:
         raise MissingParameterError()
-    return set(map(str.strip, params[0].split(",")))
+    values = frozenset(sys.intern(p) for p in map(str.strip, params[0].split(",")) if p)
+    if len(values) == 0:
+        raise MissingParameterError()
+    return values
+
 
+def read_tags(params):
+    # Tags are case-insensitive, TagMapping expects them in lowercase
+    return frozenset(sys.intern(t.lower()) for t in read_parameters(params))
 
-CommandHandler = Callable[
-    [str, str, List[str], Dict[str, str], StorageContainer, Any], str
-]
 
-Command = collections.namedtuple(
-    "Command", "command syntax help handler", defaults=["", "", lambda *a: None]
-)
+CommandHandler = Callable[[str, str, List[str], StorageContainer, TagMapping, Any], str]
+
+Command = collections.namedtuple("Command", "command syntax help handler")
 
 
 def command_help(
@@ -156,13 +389,28 @@ def command_help(
     command: str,
     params: List[str],
     storage: StorageContainer,
+    tags: TagMapping,
+    bot_handler: Any = None,
+) -> str:
+    return TaggerBotHandler.help_message
+
+
+def command_list(
+    sender: str,
+    command: str,
+    params: List[str],
+    storage: StorageContainer,
+    tags: TagMapping,
     bot_handler: Any = None,
 ) -> str:
-    return TaggerBotHandler.help_text()
+    return _("Hi @**{}**, you are currently tagged with: {}").format(
+        sender,
+        ", ".join(tags.find(user=sender)),
+    )
 
 
 class Command_Manage:
-    def __init__(self, parser=lambda *a: [], mutator=lambda *a: None):
+    def __init__(self, parser, mutator):
         self.parser = parser
         self.mutator = mutator
 
@@ -172,15 +420,12 @@ class Command_Manage:
         command: str,
         params: List[str],
         storage: StorageContainer,
+        tags: TagMapping,
         bot_handler: Any = None,
     ) -> str:
         all_tags = self.parser(params)
-        with TagMapping().use(storage) as tags:
-            self.mutator(tags, sender, *all_tags)
-            return _("Hi @**{}**, you are currently tagged with: {}").format(
-                sender,
-                ", ".join(tags.find(user=sender)),
-            )
+        self.mutator(tags, sender, *all_tags)
+        return command_list(sender, command, params, storage, tags, bot_handler)
 
 
 def command_search(
@@ -188,59 +433,65 @@ def command_search(
     command: str,
     params: List[str],
     storage: StorageContainer,
+    tags: TagMapping,
     bot_handler: Any = None,
 ) -> str:
-    all_tags = read_parameters(params)
-    with TagMapping().use(storage) as tags:
-        for tag in all_tags:
-            if tag.lower() not in tags:
-                nearest, ratio = tags.nearest(tag.lower())
-                if ratio > 0.75:
-                    return _("Hi @**{}**, I don't know the tag '{}'").format(
-                        sender,
-                        tag,
-                        nearest,
-                    )
-                else:
-                    return _(
-                        "Hi @**{}**, I don't know the tag '{}' - did you mean '{}'?"
-                    ).format(
-                        sender,
-                        tag,
-                    )
-
-        results = [tags.find(tag=tag) for tag in all_tags]
-        limit = set(storage.get("limit", []))
-        if len(limit) > 0:
-            intersection = limit.intersection(*results)
-        else:
-            intersection = results[0].intersection(*results[:1])
-        return _("Hi @**{}**, here's a list of everybody tagged with: {}\n\n{}").format(
-            sender,
-            (" " + _("and") + " ").join(all_tags),
-            "\n".join("- @**{}**".format(user) for user in intersection),
+    all_tags = read_tags(params)
+    for tag in all_tags:
+        if tag not in tags:
+            nearest, ratio = tags.nearest(tag)
+            if ratio > SUGGESTION_THRESHOLD:
+                return _(
+                    "Hi @**{}**, I don't know the tag '{}' - did you mean '{}'?"
+                ).format(
+                    sender,
+                    tag,
+                    nearest,
+                )
+            else:
+                return _("Hi @**{}**, I don't know the tag '{}'").format(
+                    sender,
+                    tag,
+                )
+
+    return _("Hi @**{}**, here's a list of everybody tagged with: {}\n\n{}").format(
+        sender,
+        (" " + _("and") + " ").join(all_tags),
+        "\n".join(f"- @**{user}**" for user in tags.search(all_tags)),
+    )
+
+
+def limit_message(tags: TagMapping) -> str:
+    if len(tags.limit) > 0:
+        return _("Tag search is currently limited to: {}").format(
+            ", ".join(sorted(tags.limit))
         )
+    else:
+        return _("Tag search is currently unlimited")
 
 
 def command_limit(
-    self,
     sender: str,
     command: str,
     params: List[str],
     storage: StorageContainer,
+    tags: TagMapping,
     bot_handler: Any = None,
 ) -> str:
-    if command == _("limit"):
-        users = read_parameters(params)
-        limit = set(storage.get("limit", []))
-        limit = limit.union(users)
-    elif command == _("unlimit"):
-        limit = []
-    storage.put("limit", list(limit))
-    if len(limit) > 0:
-        return _("Tag search is currently limited to: {}").format(", ".join(limit))
-    else:
-        return _("Tag search is currently unlimited")
+    tags.set_limit(tags.limit.union(read_parameters(params)))
+    return limit_message(tags)
+
+
+def command_unlimit(
+    sender: str,
+    command: str,
+    params: List[str],
+    storage: StorageContainer,
+    tags: TagMapping,
+    bot_handler: Any = None,
+) -> str:
+    tags.set_limit(())
+    return limit_message(tags)
 
 
 class TaggerBotHandler:
@@ -248,7 +499,12 @@ class TaggerBotHandler:
     This plugin provides simple interface to store and query random tags
     provided by users.
 
-    Data is stored using zulip's bot storage system.
+    Data is stored using zulip's bot storage system, or in a JSON file if
+    the `storage` option names one. The data is loaded into a single
+    TagMapping that all messages share. Every handler opens its own
+    storage, a JSON file is reloaded when it was changed on disk by anyone
+    else. Zulip calls `handle_message` serially, so the mapping is not
+    locked.
 
     There are three index lists:
     - users: A list of all users that have any tags on them
@@ -262,6 +518,7 @@ class TaggerBotHandler:
     }
 
     strings: Dict[str, str] = {}  # For i18n of all text
+    help_message = ""  # Formatted by build_commands
 
     @classmethod
     def build_commands(cls) -> List[Tuple[str, str, str, Command]]:
@@ -283,19 +540,19 @@ class TaggerBotHandler:
                 _("list"),
                 "",
                 _("Show all tags currently applied to the user."),
-                Command_Manage(),
+                command_list,
             ),
             Command(
                 _("add"),
                 _("<tag>, <tag>, ..."),
                 _("To add personal tag(s)."),
-                Command_Manage(read_parameters, TagMapping.add),
+                Command_Manage(read_tags, TagMapping.add),
             ),
             Command(
                 _("remove"),
                 _("<tag>, <tag>, ..."),
                 _("To remove personal tag(s)."),
-                Command_Manage(read_parameters, TagMapping.remove),
+                Command_Manage(read_tags, TagMapping.remove),
             ),
             Command(
                 _("search"),
@@ -309,8 +566,9 @@ class TaggerBotHandler:
                 _("Limit search to this group of users."),
                 command_limit,
             ),
-            Command(_("unlimit"), "", _("Remove all search limits."), command_limit),
+            Command(_("unlimit"), "", _("Remove all search limits."), command_unlimit),
         ]
+        cls.help_message = cls.help_text()
         return {cmd.command: cmd.handler for cmd in cls.commands}
 
     @classmethod
@@ -340,40 +598,48 @@ class TaggerBotHandler:
                 self.storage = val
         logger.debug(self.config_info)
         self.commands = self.build_commands()
+        # The mapping is loaded once and kept up to date in memory, it is
+        # only written back to storage after a command changed it.
+        self._storage = self.open_storage(bot_handler)
+        self.tags = TagMapping().load(self._storage)
 
     def usage(self) -> str:
-        return self.help_text()
-
-    def handle_message(self, message: Dict[str, str], bot_handler: Any) -> None:
-        quoted_name = bot_handler.identity().mention
-        original_content = message["content"].strip()
+        return self.help_message
 
+    def open_storage(self, bot_handler: Any) -> StorageContainer:
         if self.storage.endswith(".json"):
-            storage = JsonFileStorage(self.storage)
-        else:
-            storage = ZulipStorage(bot_handler)
+            return JsonFileStorage(self.storage)
+        return ZulipStorage(bot_handler)
 
-        if ":" not in original_content:
-            command, *params = original_content.strip().split(" ", 1)
-        else:
-            command, *params = original_content.strip().split(":", 1)
+    def handle_message(self, message: Dict[str, str], bot_handler: Any) -> None:
+        original_content = message["content"].strip()
+        storage = self._storage
+        if storage.refresh():
+            self.tags.load(storage)
+
+        command, sep, rest = original_content.partition(":")
+        if not sep:
+            command, sep, rest = original_content.partition(" ")
+        params = [rest] if rest else []
         if "sender_full_name" in message:
             sender = message["sender_full_name"]
         else:
             sender = message["sender_email"]
+        handler = self.commands.get(command)
+        if handler is None:
+            bot_handler.send_reply(
+                message, _("Sorry, '{}' is not a command I understand.").format(command)
+            )
+            return
         try:
-            handler = self.commands[command]
-            response = handler(sender, command, params, storage, bot_handler)
+            response = handler(sender, command, params, storage, self.tags, bot_handler)
+            self.tags.store(storage)
             if response is not None:
                 bot_handler.send_reply(message, response)
         except MissingParameterError:
             bot_handler.send_reply(
                 message, _("Sorry, I didn't understand you, a parameter is missing")
             )
-        except KeyError as err:
-            bot_handler.send_reply(
-                message, _("Sorry, '{}' is not a command I understand.").format(err)
-            )
         except Exception as err:
             logger.exception(err)
 